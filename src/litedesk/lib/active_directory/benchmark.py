@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the cost of materializing search results as model instances
+with the rows/columns result modes.
+
+Without arguments a synthetic result set is used so only the client side
+is measured; with the LITEDESK_LIB_ACTIVE_DIRECTORY_* environment
+variables set (see test.py) the searches run against the directory."""
+
+import os
+import sys
+import time
+
+from session import Session
+from classes.base import User
+
+
+ATTRS = ['department', 'last_logon_timestamp', 'user_account_control']
+# AD refuses to return more than MaxPageSize (1000) entries unpaged
+PAGE_SIZE = 1000
+
+
+class SyntheticConnection(object):
+
+    root_dn = 'DC=example,DC=com'
+
+    def __init__(self, size):
+        self.__entries = [
+            (
+                'CN=user{0},OU=bench,DC=example,DC=com'.format(n),
+                {
+                    'objectClass': ['top', 'person', 'organizationalPerson', 'user'],
+                    'distinguishedName': ['CN=user{0},OU=bench,DC=example,DC=com'.format(n)],
+                    'sAMAccountName': ['user{0}'.format(n)],
+                    'department': ['dept{0}'.format(n % 50)],
+                    'lastLogonTimestamp': [str(130000000000000000 + n)],
+                    'userAccountControl': ['512'],
+                    'mail': ['user{0}@example.com'.format(n)],
+                }
+            )
+            for n in xrange(size)
+        ]
+
+    def paged_search(self, base, scope, query, attrlist=None, timeout=None,
+                     page_size=PAGE_SIZE):
+        for start in xrange(0, len(self.__entries), page_size):
+            yield self.__entries[start:start + page_size]
+
+
+def measure(label, func, repeat=3):
+    best = min(timed(func) for n in xrange(repeat))
+    print('{0:<12} {1:8.3f}s'.format(label, best))
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def main(size=100000):
+    try:
+        conn = Session(
+            os.environ['LITEDESK_LIB_ACTIVE_DIRECTORY_URL'],
+            os.environ['LITEDESK_LIB_ACTIVE_DIRECTORY_DN'],
+            os.environ['LITEDESK_LIB_ACTIVE_DIRECTORY_PASSWORD'],
+            insecure=True
+        )
+    except KeyError:
+        conn = SyntheticConnection(size)
+    measure('instances', lambda: User.search(conn, page_size=PAGE_SIZE))
+    measure('rows', lambda: User.search(
+        conn, as_='rows', attrs=ATTRS, page_size=PAGE_SIZE
+    ))
+    measure('columns', lambda: User.search(
+        conn, as_='columns', attrs=ATTRS, page_size=PAGE_SIZE
+    ))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
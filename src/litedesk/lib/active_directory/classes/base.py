@@ -19,8 +19,14 @@ import weakref
 import random
 import string
 from codecs import utf_16_le_encode
+from collections import Counter, namedtuple
 
 import ldap
+import ldap.dn
+from ldap.controls import LDAPControl
+
+
+LDAP_SERVER_TREE_DELETE_OID = '1.2.840.113556.1.4.805'
 
 
 class _AttributeFactory(object):
@@ -151,11 +157,14 @@ class _BaseObjectMetaclass(type):
             }
         def _raw_attrs(self):
             return attrs.viewvalues()
+        def _attributes(cls):
+            return attrs
 
         return {
             '_raw_set': _raw_set,
             '_moddict': property(_moddict),
-            '_raw_attrs': property(_raw_attrs)
+            '_raw_attrs': property(_raw_attrs),
+            '_attributes': classmethod(_attributes)
         }
 
 
@@ -177,6 +186,7 @@ class BaseObject(object):
 
     _base_search_query = '(objectClass=*)'
     _preset = {}
+    _row_types = {}
 
     def __init__(self, session, **kwargs):
         self._session = session
@@ -241,31 +251,172 @@ class BaseObject(object):
     def concat_search_query(a, b):
         return '(&{0}{1})'.format(a, b)
 
+    @staticmethod
+    def _flatten(value):
+        return value[0] if len(value) == 1 and isinstance(value, list) else value
+
+    @classmethod
+    def _from_entry(cls, conn, entry):
+        return cls(
+            conn,
+            **{
+                key: cls._flatten(value)
+                for key, value in entry[1].viewitems()
+            }
+        )
+
+    @classmethod
+    def _resolve_attrs(cls, names):
+        attrs = cls._attributes()
+        by_ad_key = {attr.ad_key: attr for attr in attrs.viewvalues()}
+        resolved = []
+        for name in names:
+            try:
+                resolved.append(attrs.get(name) or by_ad_key[name])
+            except KeyError:
+                raise KeyError(
+                    '{0} has no attribute {1}'.format(cls.__name__, name)
+                )
+        return resolved
+
     @classmethod
-    def search(cls, conn, base=None, query=None):
+    def _row_type(cls, fields):
+        try:
+            return cls._row_types[(cls, fields)]
+        except KeyError:
+            row_type = namedtuple('{0}Row'.format(cls.__name__), fields)
+            cls._row_types[(cls, fields)] = row_type
+            return row_type
+
+    @classmethod
+    def _search_args(cls, conn, base, query):
         if base is None:
             base = conn.root_dn
         if query is None:
             query = cls.base_search_query()
         else:
             query = cls.concat_search_query(cls.base_search_query(), query)
-        return [
-            cls(
-                conn,
-                **{
-                    key: value[0]
-                    if len(value) == 1 and isinstance(value, list) else value
-                    for key, value in entry[1].viewitems()
-                }
+        return base, query
+
+    @classmethod
+    def search(cls, conn, base=None, query=None, as_=None, attrs=None,
+               timeout=None, sizelimit=0, page_size=None, forest=False):
+        """Return instances, or with as_='rows'/'columns' namedtuples or
+        a dict of value lists built straight from the LDAP results.
+        timeout (seconds or a Deadline) and sizelimit bound the search,
+        page_size fetches the results in pages of that size and forest
+        searches all the domains of the forest (from its root by default).
+        sizelimit can't be combined with page_size or forest. Forest
+        searches return rows or columns only: their entries come from
+        other domains or from the read-only Global Catalog, which this
+        session can't save or refresh."""
+        if as_ not in (None, 'rows', 'columns'):
+            raise ValueError('Unknown result mode {0!r}'.format(as_))
+        if sizelimit and (page_size or forest):
+            raise ValueError(
+                'sizelimit is not supported with page_size or forest'
             )
-            for entry in conn.search_st(base, ldap.SCOPE_SUBTREE, query)
-            if entry[0] is not None
-        ]
+        if forest and as_ is None:
+            raise ValueError("forest searches need as_='rows' or 'columns'")
+        forest_base = base
+        base, query = cls._search_args(conn, base, query)
+        if attrs is None:
+            selected = list(cls._attributes().viewvalues())
+            attrlist = None
+        else:
+            selected = cls._resolve_attrs(attrs)
+            attrlist = [attr.ad_key for attr in selected]
+        if forest:
+            results = conn.forest_search(
+                forest_base, ldap.SCOPE_SUBTREE, query, attrlist,
+                timeout=timeout, page_size=page_size
+            )
+        elif page_size:
+            results = (
+                entry
+                for page in conn.paged_search(
+                    base, ldap.SCOPE_SUBTREE, query, attrlist,
+                    timeout=timeout, page_size=page_size
+                )
+                for entry in page
+            )
+        else:
+            results = conn.timed_search(
+                base, ldap.SCOPE_SUBTREE, query, attrlist,
+                timeout=timeout, sizelimit=sizelimit
+            )
+        entries = [entry for entry in results if entry[0] is not None]
+        if as_ is None:
+            return [cls._from_entry(conn, entry) for entry in entries]
+        ad_keys = [attr.ad_key for attr in selected]
+        flatten = cls._flatten
+        if as_ == 'rows':
+            row_type = cls._row_type(tuple(attr.name for attr in selected))
+            return [
+                row_type._make([
+                    flatten(values[ad_key]) if ad_key in values else None
+                    for ad_key in ad_keys
+                ])
+                for dn, values in entries
+            ]
+        return {
+            attr.name: [
+                flatten(values[attr.ad_key]) if attr.ad_key in values else None
+                for dn, values in entries
+            ]
+            for attr in selected
+        }
+
+    @classmethod
+    def count(cls, conn, query=None, base=None, timeout=None,
+              page_size=1000):
+        """Count the matching objects without fetching any attributes."""
+        base, query = cls._search_args(conn, base, query)
+        return sum(
+            1
+            for page in conn.paged_search(
+                base, ldap.SCOPE_SUBTREE, query, ['1.1'],
+                timeout=timeout, page_size=page_size
+            )
+            for dn, attrs in page
+            if dn is not None
+        )
 
-    def update_from_ad(self):
+    @classmethod
+    def exists(cls, conn, query=None, base=None, timeout=None):
+        base, query = cls._search_args(conn, base, query)
+        try:
+            entries = conn.timed_search(
+                base, ldap.SCOPE_SUBTREE, query, ['1.1'],
+                timeout=timeout, sizelimit=1
+            )
+        except ldap.SIZELIMIT_EXCEEDED:
+            return True
+        return any(dn is not None for dn, attrs in entries)
+
+    @classmethod
+    def group_count(cls, conn, attr, query=None, base=None, timeout=None,
+                    page_size=1000):
+        """Count the matching objects per value of attr, fetching only
+        that attribute. Objects without the attribute count under None."""
+        base, query = cls._search_args(conn, base, query)
+        ad_key = cls._resolve_attrs([attr])[0].ad_key
+        counts = Counter()
+        for page in conn.paged_search(
+            base, ldap.SCOPE_SUBTREE, query, [ad_key],
+            timeout=timeout, page_size=page_size
+        ):
+            for dn, values in page:
+                if dn is not None:
+                    counts.update(values.get(ad_key) or [None])
+        return counts
+
+    def update_from_ad(self, timeout=None):
         query = '(distinguishedName={0})'.format(self.distinguished_name)
         try:
-            other = self.__class__.search(self._session, query=query)[0]
+            other = self.__class__.search(
+                self._session, query=query, timeout=timeout
+            )[0]
             diff = self.diff(other)
             for attr in self._raw_attrs:
                 self._raw_set(attr.name, attr.getter(self), False)
@@ -282,8 +433,9 @@ class BaseObject(object):
             return False
 
 
-    def save(self):
-        if not self.update_from_ad():
+    def save(self, timeout=None):
+        deadline = self._session.deadline(timeout)
+        if not self.update_from_ad(deadline):
             for attr in self._raw_attrs:
                 if (
                     attr.name != 'distinguished_name' and
@@ -297,19 +449,63 @@ class BaseObject(object):
             for ad_key, value in self._moddict.viewitems()
         ]
         if self.object_guid is None:
-            self._session.add_s(self.distinguished_name, modlist)
+            self._session.timed_add(self.distinguished_name, modlist, deadline)
         else:
             modlist = [
                 (ldap.MOD_REPLACE, ad_key, value)
                 for ad_key, value in modlist
             ]
-            self._session.modify_s(self.distinguished_name, modlist)
+            self._session.timed_modify(
+                self.distinguished_name, modlist, deadline
+            )
         for attr in self._raw_attrs:
             self._raw_set(attr.name, attr.getter(self), False)
-        self.update_from_ad()
+        self.update_from_ad(deadline)
 
-    def delete(self):
-        self._session.delete_s(self.distinguished_name)
+    def delete(self, timeout=None, recursive=False, concurrency=16):
+        """Delete the object, with recursive=True including everything
+        beneath it."""
+        if not recursive:
+            self._session.timed_delete(self.distinguished_name, timeout)
+            return
+        deadline = self._session.deadline(timeout)
+        tree_delete = LDAPControl(LDAP_SERVER_TREE_DELETE_OID, True, None)
+        while True:
+            try:
+                self._session.timed_delete(
+                    self.distinguished_name, deadline,
+                    serverctrls=[tree_delete]
+                )
+                return
+            except ldap.ADMIN_LIMIT_EXCEEDED:
+                # AD deletes large trees in chunks, repeat until it's gone
+                continue
+            except ldap.UNAVAILABLE_CRITICAL_EXTENSION:
+                break
+        self._delete_subtree(deadline, concurrency)
+
+    def _delete_subtree(self, deadline, concurrency):
+        levels = {}
+        for page in self._session.paged_search(
+            self.distinguished_name, ldap.SCOPE_SUBTREE, '(objectClass=*)',
+            ['1.1'], timeout=deadline
+        ):
+            for dn, attrs in page:
+                if dn is not None:
+                    levels.setdefault(len(ldap.dn.explode_dn(dn)), []).append(dn)
+        for depth in sorted(levels, reverse=True):
+            errors = [
+                error
+                for operation, error in self._session.pipeline(
+                    [('delete_ext', (dn,)) for dn in levels[depth]],
+                    concurrency=concurrency,
+                    timeout=deadline
+                )
+                if error is not None
+            ]
+            # The whole level is finished before failing, nothing stays in flight
+            if errors:
+                raise errors[0]
 
 
 class Company(BaseObject):
@@ -340,10 +536,10 @@ class Company(BaseObject):
             self._session.root_dn
         )
 
-    def save(self):
+    def save(self, timeout=None):
         if not self.distinguished_name:
             self.distinguished_name = self._distinguished_name()
-        super(Company, self).save()
+        super(Company, self).save(timeout)
 
 
 class User(BaseObject):
@@ -407,24 +603,26 @@ class User(BaseObject):
     def activate(self):
         self.user_account_control = self.USER_ACCOUNT_CONTROL_ACTIVE
 
-    def set_password(self, password):
+    def set_password(self, password, timeout=None):
+        deadline = self._session.deadline(timeout)
         encoded_password = utf_16_le_encode('"{0}"'.format(password))[0]
-        self._session.modify_s(self.distinguished_name, [(ldap.MOD_REPLACE, 'unicodePwd', encoded_password)])
-        self.update_from_ad()
+        self._session.timed_modify(self.distinguished_name, [(ldap.MOD_REPLACE, 'unicodePwd', encoded_password)], deadline)
+        self.update_from_ad(deadline)
 
-    def set_one_time_password(self, password=None):
+    def set_one_time_password(self, password=None, timeout=None):
+        deadline = self._session.deadline(timeout)
         password = password or ''.join([
             random.choice(string.ascii_letters + string.digits)
             for n in xrange(8)
         ])
-        self.set_password(password)
-        self._session.modify_s(self.distinguished_name, [(ldap.MOD_REPLACE, 'pwdLastSet', '0')])
-        self.update_from_ad()
+        self.set_password(password, deadline)
+        self._session.timed_modify(self.distinguished_name, [(ldap.MOD_REPLACE, 'pwdLastSet', '0')], deadline)
+        self.update_from_ad(deadline)
         return password
 
-    def save(self):
+    def save(self, timeout=None):
         if not self.distinguished_name:
             self.distinguished_name = self._distinguished_name()
         if self.user_account_control is None:
             self.user_account_control = self.INITIAL_ACCOUNT_CONTROL_VALUE
-        super(User, self).save()
+        super(User, self).save(timeout)
@@ -0,0 +1,292 @@
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+from itertools import izip
+
+import ldap
+import ldap.dn
+import ldap.filter
+
+from classes.base import ReadOnlyAttribute, User
+
+
+ACCOUNTDISABLE = 0x2
+# Keys per filter when looking up desired users outside the company
+LOOKUP_BATCH_SIZE = 200
+
+Change = collections.namedtuple('Change', 'action key dn method args')
+Result = collections.namedtuple('Result', 'change error')
+
+
+def _values(value):
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return sorted(
+        item.encode() if isinstance(item, unicode) else str(item)
+        for item in value
+    )
+
+
+def _same_dn(a, b):
+    return (
+        [rdn.lower() for rdn in ldap.dn.explode_dn(a)] ==
+        [rdn.lower() for rdn in ldap.dn.explode_dn(b)]
+    )
+
+
+class Reconciler(object):
+    """Bring the users of a company in line with a desired state.
+
+    The desired state is an iterable of dicts keyed by User attribute names
+    (or AD keys), identified by key (s_am_account_name or object_guid). An
+    item may name a Company as parent to have the user moved there. Desired
+    users not found in the company are looked up in the whole domain and
+    moved into the company (or their parent); only unknown users are added.
+    Users of the company missing from the desired state are disabled,
+    deleted or left alone depending on missing ('disable', 'delete' or
+    None)."""
+
+    KEYS = ('s_am_account_name', 'object_guid')
+
+    def __init__(self, session, company, key='s_am_account_name',
+                 missing='disable', concurrency=16, page_size=1000,
+                 timeout=None):
+        if key not in self.KEYS:
+            raise ValueError('Unsupported reconciliation key {0}'.format(key))
+        if missing not in (None, 'disable', 'delete'):
+            raise ValueError('Unsupported missing policy {0}'.format(missing))
+        self.__session = session
+        self.__company = company
+        self.__key = key
+        self.__missing = missing
+        self.__concurrency = concurrency
+        self.__page_size = page_size
+        self.__timeout = timeout
+
+    def __index_key(self, value):
+        # sAMAccountName is case-insensitive in AD
+        if self.__key == 's_am_account_name':
+            return value.lower()
+        return value
+
+    def __normalize(self, item, attrs):
+        normalized = {}
+        for name, value in item.iteritems():
+            if name != 'parent':
+                if name not in attrs:
+                    attrs[name] = User._resolve_attrs([name])[0]
+                name = attrs[name].name
+            normalized[name] = value
+        return normalized
+
+    def __attrs(self, desired):
+        names = set([self.__key, 'distinguished_name', 'user_account_control'])
+        for item in desired.itervalues():
+            names.update(name for name in item if name != 'parent')
+        attrs = User._resolve_attrs(sorted(names))
+        for attr in attrs:
+            if (
+                isinstance(attr, ReadOnlyAttribute) and
+                attr.name != self.__key
+            ):
+                raise ldap.UNWILLING_TO_PERFORM(
+                    "{0} attribute is Read-Only".format(attr.ad_key)
+                )
+        return attrs
+
+    def __lookup(self, keys, attrs, deadline):
+        """Find users outside the company by key, batching the keys into
+        OR filters searched over the whole domain."""
+        key_attr = User._resolve_attrs([self.__key])[0]
+        # objectGUID is binary, escape every byte of it
+        escape_mode = 2 if self.__key == 'object_guid' else 0
+        keys = list(keys)
+        rows = []
+        for start in xrange(0, len(keys), LOOKUP_BATCH_SIZE):
+            query = '(|{0})'.format(''.join(
+                '({0}={1})'.format(
+                    key_attr.ad_key,
+                    ldap.filter.escape_filter_chars(key, escape_mode)
+                )
+                for key in keys[start:start + LOOKUP_BATCH_SIZE]
+            ))
+            rows.extend(User.search(
+                self.__session,
+                query=query,
+                as_='rows',
+                attrs=[attr.name for attr in attrs],
+                timeout=deadline,
+                page_size=self.__page_size
+            ))
+        return rows
+
+    def __add(self, key, item):
+        user = User(
+            self.__session,
+            **dict(item, parent=item.get('parent', self.__company))
+        )
+        user.distinguished_name = user._distinguished_name()
+        if user.user_account_control is None:
+            user.user_account_control = User.INITIAL_ACCOUNT_CONTROL_VALUE
+        modlist = [
+            (attr.ad_key, attr.getter(user))
+            for attr in user._raw_attrs
+            if (
+                attr.name != 'distinguished_name' and
+                attr.getter(user) is not None
+            )
+        ]
+        return Change(
+            'add', key, user.distinguished_name,
+            'add_ext', (user.distinguished_name, modlist)
+        )
+
+    def __update(self, key, item, row, attrs, parent):
+        dn = row.distinguished_name
+        modlist = [
+            (ldap.MOD_REPLACE, attrs[name].ad_key, _values(value) or None)
+            for name, value in item.iteritems()
+            if (
+                name not in ('parent', self.__key) and
+                _values(value) != _values(getattr(row, name))
+            )
+        ]
+        if modlist:
+            yield Change('modify', key, dn, 'modify_ext', (dn, modlist))
+        if parent is not None:
+            parent_dn = parent.distinguished_name
+            rdns = ldap.dn.explode_dn(dn)
+            if not _same_dn(','.join(rdns[1:]), parent_dn):
+                yield Change('move', key, dn, 'rename', (dn, rdns[0], parent_dn))
+
+    def __retire(self, key, row):
+        dn = row.distinguished_name
+        if self.__missing == 'delete':
+            return Change('delete', key, dn, 'delete_ext', (dn,))
+        account_control = int(row.user_account_control or 0)
+        if self.__missing == 'disable' and not account_control & ACCOUNTDISABLE:
+            modlist = [(
+                ldap.MOD_REPLACE, 'userAccountControl',
+                str(account_control | ACCOUNTDISABLE)
+            )]
+            return Change('disable', key, dn, 'modify_ext', (dn, modlist))
+        return None
+
+    def __deadline(self, timeout):
+        return self.__session.deadline(
+            self.__timeout if timeout is None else timeout
+        )
+
+    def plan(self, desired, timeout=None):
+        """Compute the changes needed to reach the desired state.
+        The company is read in one paged, projected search, desired users
+        not found there are then looked up by key in batches."""
+        deadline = self.__deadline(timeout)
+        resolved = {}
+        desired = collections.OrderedDict(
+            (self.__index_key(item[self.__key]), item)
+            for item in (self.__normalize(item, resolved) for item in desired)
+        )
+        attrs = self.__attrs(desired)
+        rows = User.search(
+            self.__session,
+            base=self.__company.distinguished_name,
+            as_='rows',
+            attrs=[attr.name for attr in attrs],
+            timeout=deadline,
+            page_size=self.__page_size
+        )
+        current = {
+            self.__index_key(getattr(row, self.__key)): row for row in rows
+        }
+        # Users moved out of the company, or to be moved into it
+        elsewhere = {
+            self.__index_key(getattr(row, self.__key)): row
+            for row in self.__lookup(
+                (item[self.__key] for key, item in desired.iteritems()
+                 if key not in current),
+                attrs,
+                deadline
+            )
+        }
+        attrs = {attr.name: attr for attr in attrs}
+        changes = []
+        for key, item in desired.iteritems():
+            row = current.pop(key, None)
+            if row is not None:
+                changes.extend(self.__update(
+                    key, item, row, attrs, item.get('parent')
+                ))
+            elif key in elsewhere:
+                # Users outside the company are moved into it by default
+                changes.extend(self.__update(
+                    key, item, elsewhere[key], attrs,
+                    item.get('parent', self.__company)
+                ))
+            elif self.__key != 'object_guid':
+                # Objects cannot be created with a given objectGUID
+                changes.append(self.__add(key, item))
+        for key, row in current.iteritems():
+            change = self.__retire(key, row)
+            if change is not None:
+                changes.append(change)
+        return changes
+
+    def execute(self, changes, timeout=None):
+        """Apply the changes with at most concurrency operations in flight
+        and return a Result for each of them.
+        Moves run last so they don't race the modifications of the same
+        user, which address it by its old DN.
+        If the deadline passes or the connection fails, the changes that
+        did not complete get a Result carrying that error."""
+        deadline = self.__deadline(timeout)
+        results = []
+        failure = None
+        for phase in (('add', 'modify', 'disable', 'delete'), ('move',)):
+            phase_changes = [
+                change for change in changes if change.action in phase
+            ]
+            done = 0
+            if failure is None:
+                outcomes = self.__session.pipeline(
+                    [(change.method, change.args) for change in phase_changes],
+                    concurrency=self.__concurrency,
+                    timeout=deadline
+                )
+                try:
+                    for change, (operation, error) in izip(
+                        phase_changes, outcomes
+                    ):
+                        results.append(Result(change, error))
+                        done += 1
+                except ldap.LDAPError as e:
+                    failure = e
+            if failure is not None:
+                results.extend(
+                    Result(change, failure) for change in phase_changes[done:]
+                )
+        return results
+
+    def run(self, desired, dry_run=False, timeout=None):
+        """Plan and apply the changes. A dry run only returns the plan.
+        Planning and execution share one deadline."""
+        deadline = self.__deadline(timeout)
+        changes = self.plan(desired, deadline)
+        if dry_run:
+            return changes
+        return self.execute(changes, deadline)
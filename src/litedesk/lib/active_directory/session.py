@@ -14,10 +14,90 @@
 
 
 from __future__ import unicode_literals
+import collections
+import math
+import re
+import time
 import warnings
 import weakref
 
 import ldap
+import ldap.dn
+import ldapurl
+from ldap.controls import SimplePagedResultsControl
+
+from subscription import Subscription
+
+
+# Attributes of the partial attribute set replicated to the Global Catalog
+GLOBAL_CATALOG_ATTRIBUTES = frozenset([
+    'cn', 'description', 'displayname', 'distinguishedname', 'givenname',
+    'instancetype', 'mail', 'memberof', 'name', 'objectcategory',
+    'objectclass', 'objectguid', 'objectsid', 'ou',
+    'physicaldeliveryofficename', 'primarygroupid', 'samaccountname',
+    'samaccounttype', 'sn', 'telephonenumber', 'useraccountcontrol',
+    'userprincipalname', 'usnchanged', 'usncreated', 'whenchanged',
+    'whencreated',
+])
+
+# Referrals to these naming contexts never hold users or companies
+NON_DOMAIN_PARTITIONS = frozenset([
+    'dc=domaindnszones', 'dc=forestdnszones', 'cn=configuration',
+])
+
+# Errors after which no further operation can succeed on the connection
+CONNECTION_ERRORS = (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.CONNECT_ERROR)
+
+_FILTER_ATTRIBUTE = re.compile(r'\(\s*([A-Za-z][\w-]*)[^()=]*=')
+_INSTANCE_TYPE_TERM = re.compile(r'\(\s*instanceType\s*=\s*\d+\s*\)', re.I)
+_REFERRAL_URL = re.compile(r'ldaps?://\S+', re.I)
+
+
+def _global_catalog_eligible(query, attrlist):
+    if attrlist is None:
+        return False
+    attrs = set(attr.lower() for attr in attrlist)
+    attrs.update(attr.lower() for attr in _FILTER_ATTRIBUTE.findall(query))
+    return attrs.issubset(GLOBAL_CATALOG_ATTRIBUTES)
+
+
+def _global_catalog_query(query):
+    """Objects of other domains are read-only replicas on the Global
+    Catalog and lack the writable instanceType bit, only require the
+    attribute to be present."""
+    return _INSTANCE_TYPE_TERM.sub('(instanceType=*)', query)
+
+
+def _referral_urls(error):
+    """URLs of an ldap.REFERRAL result, listed in its info."""
+    info = error.args[0].get('info', '') if error.args else ''
+    return _REFERRAL_URL.findall(info)
+
+
+class Deadline(object):
+    """Time budget shared by all the LDAP calls of a single operation."""
+
+    def __init__(self, timeout=None):
+        self.__expires = None if timeout is None else time.time() + timeout
+
+    @property
+    def bounded(self):
+        return self.__expires is not None
+
+    def remaining(self):
+        """Seconds left, -1 when unbounded.
+        Raises ldap.TIMEOUT once the budget is spent."""
+        if self.__expires is None:
+            return -1
+        remaining = self.__expires - time.time()
+        if remaining <= 0:
+            raise ldap.TIMEOUT({'desc': 'Deadline exceeded'})
+        return remaining
+
+    def timelimit(self):
+        """Whole seconds left for server-side limits, -1 when unbounded."""
+        remaining = self.remaining()
+        return remaining if remaining < 0 else int(math.ceil(remaining))
 
 
 class Session(object):
@@ -26,39 +106,71 @@ class Session(object):
 
     __instances = weakref.WeakValueDictionary()
 
-    def __new__(cls, url, dn, password, insecure=False):
-        session_desc = (url, dn, password, insecure)
+    def __new__(cls, url, dn, password, insecure=False, timeout=None,
+                network_timeout=None, global_catalog_url=None):
+        session_desc = (
+            url, dn, password, insecure, timeout, network_timeout,
+            global_catalog_url
+        )
         try:
             return cls.__instances[session_desc]
         except KeyError:
-            instance = object.__new__(cls, url, dn, password, insecure)
+            instance = object.__new__(
+                cls, url, dn, password, insecure, timeout, network_timeout,
+                global_catalog_url
+            )
             cls.__instances[session_desc] = instance
             return instance
 
-    def __init__(self, url, dn, password, insecure=False):
+    def __init__(self, url, dn, password, insecure=False, timeout=None,
+                 network_timeout=None, global_catalog_url=None):
         """Initialize the session.
-        This doesn't open the connection yet."""
+        This doesn't open the connection yet.
+        timeout is the default budget in seconds of every timed_* call,
+        network_timeout bounds connecting to the server.
+        global_catalog_url defaults to the Global Catalog port of url."""
+        if '_Session__url' in self.__dict__:
+            # A cached instance from __new__, keep its connection and caches
+            return
         self.__url = url
         self.__dn = dn
         self.__password = password
         self.__insecure = insecure
+        self.__timeout = timeout
+        self.__network_timeout = network_timeout
+        self.__global_catalog_url = global_catalog_url
+        self.__global_catalog = None
+        self.__referrals = {}
+        self.__forest_root_dn = None
         self.__ldap = None
 
     def __enter__(self):
         """Initialize LDAP connection to the endpoint"""
+        self.__ldap = self.connect()
+        return self
+
+    def connect(self):
+        """Open and bind a new LDAP connection with the session settings.
+        The caller owns the returned connection."""
         if self.__insecure:
             warnings.warn(
                 'Allowing LDAP over TLS without certificate verification'
             )
             ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, 0)
-        self.__ldap = ldap.initialize(self.__url)
-        self.__ldap.protocol_version = 3
-        self.__ldap.set_option(ldap.OPT_REFERRALS, 0)
-        self.__ldap.set_option(ldap.OPT_X_TLS_DEMAND, True)
-        self.__ldap.set_option(ldap.OPT_DEBUG_LEVEL, 255)
+        connection = ldap.initialize(self.__url)
+        connection.protocol_version = 3
+        connection.set_option(ldap.OPT_REFERRALS, 0)
+        connection.set_option(ldap.OPT_X_TLS_DEMAND, True)
+        connection.set_option(ldap.OPT_DEBUG_LEVEL, 255)
+        if self.__network_timeout is not None:
+            connection.set_option(
+                ldap.OPT_NETWORK_TIMEOUT, self.__network_timeout
+            )
+        if self.__timeout is not None:
+            connection.set_option(ldap.OPT_TIMEOUT, self.__timeout)
 
-        self.__ldap.simple_bind_s(self.__dn, self.__password)
-        return self
+        connection.simple_bind_s(self.__dn, self.__password)
+        return connection
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Finalize the connection"""
@@ -73,6 +185,258 @@ class Session(object):
     def active(self):
         return self.__ldap is not None
 
+    @property
+    def forest_root_dn(self):
+        if self.__forest_root_dn is None:
+            dn, attrs = self.timed_search(
+                b'', ldap.SCOPE_BASE, b'(objectClass=*)',
+                [b'rootDomainNamingContext']
+            )[0]
+            self.__forest_root_dn = attrs['rootDomainNamingContext'][0]
+        return self.__forest_root_dn
+
+    def __session(self, url):
+        return Session(
+            url, self.__dn, self.__password, self.__insecure,
+            self.__timeout, self.__network_timeout
+        )
+
+    @property
+    def global_catalog(self):
+        """Session on the Global Catalog port of the same server."""
+        if self.__global_catalog is None:
+            url = self.__global_catalog_url
+            if url is None:
+                parsed = ldapurl.LDAPUrl(self.__url)
+                url = '{0}://{1}:{2}'.format(
+                    parsed.urlscheme,
+                    parsed.hostport.rsplit(':', 1)[0],
+                    3269 if parsed.urlscheme == 'ldaps' else 3268
+                )
+            self.__global_catalog = self.__session(url)
+        return self.__global_catalog
+
+    def referral_session(self, hostport):
+        """Session on the domain controller at hostport, bound with the
+        same credentials and kept open for later referrals."""
+        hostport = hostport.lower()
+        try:
+            return self.__referrals[hostport]
+        except KeyError:
+            session = self.__session('{0}://{1}'.format(
+                ldapurl.LDAPUrl(self.__url).urlscheme, hostport
+            ))
+            self.__referrals[hostport] = session
+            return session
+
+    def deadline(self, timeout=None):
+        """Return a Deadline for timeout seconds (the session default when
+        None). An existing Deadline is passed through unchanged, so the
+        remaining budget carries over multi-step operations."""
+        if isinstance(timeout, Deadline):
+            return timeout
+        return Deadline(self.__timeout if timeout is None else timeout)
+
+    def subscribe(self, base=None, callback=None, models=None):
+        """Subscribe to change notifications for objects under base.
+        With a callback the notifications are dispatched from a background
+        thread, otherwise iterate over the returned Subscription. Changed
+        objects arrive as model instances, deleted ones as Deletion tuples."""
+        subscription = Subscription(
+            self, base or self.root_dn, models=models, callback=callback
+        )
+        if callback is not None:
+            subscription.start()
+        return subscription
+
+    def recycle(self):
+        """Drop the current connection, the next call opens a new one."""
+        connection, self.__ldap = self.__ldap, None
+        if connection is not None:
+            try:
+                connection.unbind_ext()
+            except ldap.LDAPError:
+                pass
+
+    def timed_result(self, msgid, timeout=None):
+        """Wait for the result of an asynchronous operation.
+        If the deadline passes first the operation is abandoned, the
+        connection recycled and ldap.TIMEOUT raised."""
+        deadline = self.deadline(timeout)
+        try:
+            return self.result3(msgid, all=1, timeout=deadline.remaining())
+        except ldap.TIMEOUT:
+            try:
+                self.abandon_ext(msgid)
+            except ldap.LDAPError:
+                pass
+            self.recycle()
+            raise
+
+    def timed_search(self, base, scope, query, attrlist=None, timeout=None,
+                     sizelimit=0, serverctrls=None):
+        deadline = self.deadline(timeout)
+        msgid = self.search_ext(
+            base, scope, query, attrlist, serverctrls=serverctrls,
+            timeout=deadline.timelimit(), sizelimit=sizelimit
+        )
+        return self.timed_result(msgid, deadline)[1]
+
+    def paged_search(self, base, scope, query, attrlist=None, timeout=None,
+                     page_size=1000):
+        """Yield the search results page by page using the simple paged
+        results control, all pages share one deadline."""
+        deadline = self.deadline(timeout)
+        control = SimplePagedResultsControl(True, size=page_size, cookie=b'')
+        while True:
+            msgid = self.search_ext(
+                base, scope, query, attrlist, serverctrls=[control],
+                timeout=deadline.timelimit()
+            )
+            rtype, rdata, rmsgid, serverctrls = self.timed_result(
+                msgid, deadline
+            )
+            yield rdata
+            cookies = [
+                ctrl.cookie for ctrl in serverctrls
+                if ctrl.controlType == SimplePagedResultsControl.controlType
+            ]
+            if not cookies or not cookies[0]:
+                return
+            control.cookie = cookies[0]
+
+    def __search(self, base, scope, query, attrlist, deadline, page_size):
+        if page_size:
+            return [
+                entry
+                for page in self.paged_search(
+                    base, scope, query, attrlist, deadline, page_size
+                )
+                for entry in page
+            ]
+        return self.timed_search(base, scope, query, attrlist, deadline)
+
+    def forest_search(self, base, scope, query, attrlist=None, timeout=None,
+                      page_size=None):
+        """Search the whole forest, from its root when base is None.
+        When the query and attrlist only involve Global Catalog attributes
+        a single search goes to the Global Catalog, otherwise the search
+        runs on this domain and referrals to the other domains are followed
+        over cached, already bound sessions."""
+        deadline = self.deadline(timeout)
+        if _global_catalog_eligible(query, attrlist):
+            return [
+                entry
+                for entry in self.global_catalog.__search(
+                    base or b'', scope, _global_catalog_query(query),
+                    attrlist, deadline, page_size
+                )
+                if entry[0] is not None
+            ]
+        pending = [(self, base or self.forest_root_dn)]
+        followed = set()
+        results = []
+        while pending:
+            session, base = pending.pop()
+            try:
+                entries = session.__search(
+                    base, scope, query, attrlist, deadline, page_size
+                )
+            except ldap.REFERRAL as e:
+                # base is held by another domain, e.g. the forest root
+                # seen from a child domain
+                entries = [(None, _referral_urls(e))]
+            for entry in entries:
+                if entry[0] is not None:
+                    results.append(entry)
+                    continue
+                for url in entry[1]:
+                    referral = ldapurl.LDAPUrl(url)
+                    if (
+                        not referral.dn or
+                        referral.dn.lower() in followed or
+                        ldap.dn.explode_dn(referral.dn)[0].lower()
+                        in NON_DOMAIN_PARTITIONS
+                    ):
+                        continue
+                    followed.add(referral.dn.lower())
+                    pending.append((
+                        self.referral_session(referral.hostport),
+                        referral.dn
+                    ))
+        return results
+
+    def pipeline(self, operations, concurrency=16, timeout=None):
+        """Run asynchronous operations, given as (method, args) pairs such
+        as ('modify_ext', (dn, modlist)), keeping up to concurrency of them
+        in flight on the connection.
+        Yields (operation, error) in submission order, error is None when
+        the operation succeeded. Errors that leave the connection unusable
+        (deadline, server down) abandon the operations in flight, recycle
+        the connection and are raised."""
+        deadline = self.deadline(timeout)
+        operations = iter(operations)
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < concurrency:
+                    operation = next(operations, None)
+                    if operation is None:
+                        break
+                    deadline.remaining()
+                    method, args = operation
+                    try:
+                        pending.append(
+                            (operation, getattr(self, method)(*args), None)
+                        )
+                    except CONNECTION_ERRORS:
+                        raise
+                    except (ldap.LDAPError, TypeError, ValueError) as e:
+                        # Rejected before it was sent, e.g. a bad modlist
+                        pending.append((operation, None, e))
+                if not pending:
+                    return
+                operation, msgid, error = pending[0]
+                if msgid is not None:
+                    try:
+                        self.timed_result(msgid, deadline)
+                    except CONNECTION_ERRORS:
+                        raise
+                    except ldap.LDAPError as e:
+                        error = e
+                pending.popleft()
+                yield operation, error
+        except CONNECTION_ERRORS:
+            # timed_result already recycled the connection if it timed out
+            if self.active:
+                for operation, msgid, error in pending:
+                    if msgid is None:
+                        continue
+                    try:
+                        self.abandon_ext(msgid)
+                    except ldap.LDAPError:
+                        pass
+                self.recycle()
+            raise
+
+    def timed_add(self, dn, modlist, timeout=None, serverctrls=None):
+        deadline = self.deadline(timeout)
+        deadline.remaining()
+        msgid = self.add_ext(dn, modlist, serverctrls=serverctrls)
+        return self.timed_result(msgid, deadline)
+
+    def timed_modify(self, dn, modlist, timeout=None, serverctrls=None):
+        deadline = self.deadline(timeout)
+        deadline.remaining()
+        msgid = self.modify_ext(dn, modlist, serverctrls=serverctrls)
+        return self.timed_result(msgid, deadline)
+
+    def timed_delete(self, dn, timeout=None, serverctrls=None):
+        deadline = self.deadline(timeout)
+        deadline.remaining()
+        msgid = self.delete_ext(dn, serverctrls=serverctrls)
+        return self.timed_result(msgid, deadline)
+
     def __get_connection(self):
         with self:
             while True:
@@ -0,0 +1,183 @@
+# Copyright 2014, Deutsche Telekom AG - Laboratories (T-Labs)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import threading
+from collections import namedtuple
+
+import ldap
+from ldap.controls import LDAPControl
+
+from classes.base import Company, User
+
+
+LDAP_SERVER_NOTIFICATION_OID = '1.2.840.113556.1.4.528'
+LDAP_SERVER_SHOW_DELETED_OID = '1.2.840.113556.1.4.417'
+
+log = logging.getLogger(__name__)
+
+# Yielded in place of an instance when an object is deleted. dn is the
+# tombstone's DN in the Deleted Objects container, object_guid is stable.
+Deletion = namedtuple('Deletion', 'model dn object_guid')
+
+
+class Subscription(object):
+    """Active Directory change notifications for the objects under base.
+    The persistent search runs on a dedicated connection which is
+    re-established (and the search re-issued) whenever it is lost.
+    Only objects whose classes match a model exactly are dispatched, so
+    e.g. computers are not taken for users. Deleted objects are
+    dispatched as Deletion tuples."""
+
+    def __init__(self, session, base, models=None, callback=None,
+                 reconnect_delay=1.0, poll_interval=1.0):
+        self.__session = session
+        self.__base = base
+        self.__models = models or (Company, User)
+        self.__ad_keys = {
+            model: frozenset(
+                attr.ad_key for attr in model._attributes().viewvalues()
+            )
+            for model in self.__models
+        }
+        self.__callback = callback
+        self.__reconnect_delay = reconnect_delay
+        self.__poll_interval = poll_interval
+        self.__connection = None
+        self.__msgid = None
+        self.__stopped = threading.Event()
+        self.__subscribed = threading.Event()
+        self.__thread = None
+
+    def __subscribe(self):
+        self.__connection = self.__session.connect()
+        self.__msgid = self.__connection.search_ext(
+            self.__base,
+            ldap.SCOPE_SUBTREE,
+            '(objectClass=*)',
+            sorted(set(['isDeleted']).union(*self.__ad_keys.values())),
+            serverctrls=[
+                LDAPControl(LDAP_SERVER_NOTIFICATION_OID, True, None),
+                LDAPControl(LDAP_SERVER_SHOW_DELETED_OID, True, None)
+            ]
+        )
+        self.__subscribed.set()
+
+    def __unsubscribe(self):
+        self.__subscribed.clear()
+        connection, self.__connection = self.__connection, None
+        if connection is None:
+            return
+        try:
+            connection.abandon_ext(self.__msgid)
+            connection.unbind_ext()
+        except ldap.LDAPError:
+            pass
+
+    def __model(self, entry):
+        object_classes = set(entry[1].get('objectClass', ())) - set(['top'])
+        for model in self.__models:
+            preset = model._preset.get('object_class', ())
+            if isinstance(preset, basestring):
+                preset = [preset]
+            if preset and object_classes == set(preset) - set(['top']):
+                return model
+        return None
+
+    def __dispatch(self, entry):
+        model = self.__model(entry)
+        if model is None:
+            return None
+        dn, values = entry
+        if values.get('isDeleted') == ['TRUE']:
+            return Deletion(model, dn, values.get('objectGUID', [None])[0])
+        known = self.__ad_keys[model]
+        return model._from_entry(self.__session, (dn, {
+            key: value for key, value in values.iteritems() if key in known
+        }))
+
+    def __iter__(self):
+        """Yield the changed objects until stop() is called."""
+        try:
+            while not self.__stopped.is_set():
+                try:
+                    if self.__connection is None:
+                        self.__subscribe()
+                    rtype, rdata = self.__connection.result(
+                        self.__msgid, 0, self.__poll_interval
+                    )
+                except ldap.TIMEOUT:
+                    continue
+                except ldap.LDAPError:
+                    log.exception(
+                        'Change notifications for %s failed, resubscribing',
+                        self.__base
+                    )
+                    self.__unsubscribe()
+                    self.__stopped.wait(self.__reconnect_delay)
+                    continue
+                if rtype == ldap.RES_SEARCH_RESULT:
+                    # The server ended the notification search, subscribe again
+                    self.__unsubscribe()
+                    continue
+                for entry in rdata or ():
+                    if entry[0] is None:
+                        continue
+                    try:
+                        change = self.__dispatch(entry)
+                    except Exception:
+                        log.exception(
+                            'Skipping change notification for %s', entry[0]
+                        )
+                        continue
+                    if change is not None:
+                        yield change
+        finally:
+            self.__unsubscribe()
+
+    def wait_subscribed(self, timeout=None):
+        """Wait until the notification search has been issued."""
+        return self.__subscribed.wait(timeout)
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            try:
+                for instance in self:
+                    try:
+                        self.__callback(instance)
+                    except Exception:
+                        log.exception('Change notification callback failed')
+            except Exception:
+                log.exception(
+                    'Change notifications for %s failed, resubscribing',
+                    self.__base
+                )
+                self.__stopped.wait(self.__reconnect_delay)
+
+    def start(self):
+        """Dispatch the changed objects to the callback from a thread."""
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if (
+            self.__thread is not None and
+            self.__thread is not threading.current_thread()
+        ):
+            self.__thread.join()
+        self.__thread = None
@@ -17,12 +17,15 @@
 
 import os
 import random
+import threading
 import unittest
 from codecs import utf_16_le_encode
 
 import ldap
 
-from session import Session
+from session import Session, _global_catalog_query, _referral_urls
+from reconcile import Reconciler
+from subscription import Deletion
 from classes.base import Company, User
 
 
@@ -41,12 +44,62 @@ class CommonTest(unittest.TestCase):
             )
 
 
+class ForestSearchTestCase(unittest.TestCase):
+
+    def test_global_catalog_query_relaxes_instance_type(self):
+        query = _global_catalog_query(User.concat_search_query(
+            User.base_search_query(), '(sAMAccountName=test.user)'
+        ))
+        self.assertNotIn('(instanceType=4)', query)
+        self.assertIn('(instanceType=*)', query)
+        self.assertIn('(objectClass=organizationalPerson)', query)
+        self.assertIn('(sAMAccountName=test.user)', query)
+
+    def test_referral_urls(self):
+        error = ldap.REFERRAL({
+            'desc': 'Referral',
+            'info': 'Referral:\nldap://example.com/DC=example,DC=com'
+        })
+        self.assertEqual(
+            _referral_urls(error), ['ldap://example.com/DC=example,DC=com']
+        )
+
+
 class SessionTestCase(CommonTest):
 
     def test_session(self):
         session = Session(self.url, self.dn, self.password, insecure=True)
         self.assertIsInstance(session.whoami_s(), str)
 
+    def test_session_reuses_connection(self):
+        session = Session(self.url, self.dn, self.password, insecure=True)
+        session.whoami_s()
+        self.assertTrue(session.active)
+        same_session = Session(self.url, self.dn, self.password, insecure=True)
+        self.assertIs(same_session, session)
+        self.assertTrue(session.active, 'Cached session lost its connection')
+
+    def test_session_deadline_exceeded(self):
+        session = Session(self.url, self.dn, self.password, insecure=True)
+        self.assertRaises(ldap.TIMEOUT, User.search, session, timeout=0)
+
+    def test_session_deadline_abandons_operation(self):
+        session = Session(self.url, self.dn, self.password, insecure=True)
+        self.assertRaises(
+            ldap.TIMEOUT,
+            session.timed_search,
+            session.root_dn, ldap.SCOPE_SUBTREE, '(objectClass=*)',
+            timeout=0.001
+        )
+        self.assertFalse(session.active, 'Connection was not recycled')
+        self.assertIsInstance(session.whoami_s(), str)
+
+    def test_session_sizelimit_with_paging(self):
+        session = Session(self.url, self.dn, self.password, insecure=True)
+        self.assertRaises(
+            ValueError, User.search, session, sizelimit=1, page_size=100
+        )
+
 
 class CompanyTestCase(CommonTest):
 
@@ -69,6 +122,45 @@ class CompanyTestCase(CommonTest):
         self.assertEqual(len(companies), 1)
         company.delete()
 
+    def test_company_change_notification(self):
+        changed = threading.Event()
+        def callback(instance):
+            if isinstance(instance, Company) and instance.ou == self.test_ou:
+                changed.set()
+        subscription = self.session.subscribe(callback=callback)
+        self.assertTrue(subscription.wait_subscribed(10), 'Subscription not issued')
+        company = Company(self.session, ou=self.test_ou)
+        company.save()
+        try:
+            self.assertTrue(changed.wait(10), 'No change notification received')
+        finally:
+            subscription.stop()
+            company.delete()
+
+    def test_company_save_deadline(self):
+        company = Company(self.session, ou=self.test_ou)
+        # The deadline covers the lookup, the add and the re-read of save()
+        self.assertRaises(ldap.TIMEOUT, company.save, timeout=0.001)
+        self.assertIsInstance(self.session.whoami_s(), str)
+        if Company.exists(self.session, '(OU={0})'.format(self.test_ou)):
+            company.delete()
+
+    def test_company_deletion_notification(self):
+        company = Company(self.session, ou=self.test_ou)
+        company.save()
+        guid = company.object_guid
+        deleted = threading.Event()
+        def callback(change):
+            if isinstance(change, Deletion) and change.object_guid == guid:
+                deleted.set()
+        subscription = self.session.subscribe(callback=callback)
+        self.assertTrue(subscription.wait_subscribed(10), 'Subscription not issued')
+        try:
+            company.delete()
+            self.assertTrue(deleted.wait(10), 'No deletion notification received')
+        finally:
+            subscription.stop()
+
     def test_company_delete(self):
         company = Company(self.session, ou=self.test_ou)
         company.save()
@@ -76,6 +168,31 @@ class CompanyTestCase(CommonTest):
         companies = Company.search(self.session, self.session.root_dn, '(OU={0})'.format(self.test_ou))
         self.assertEqual(len(companies), 0)
 
+    def company_with_user_create(self):
+        company = Company(self.session, ou=self.test_ou)
+        company.save()
+        User(
+            self.session,
+            parent=company,
+            s_am_account_name='test.user',
+            given_name='Test',
+            sn='User'
+        ).save()
+        return company
+
+    def test_company_delete_recursive(self):
+        company = self.company_with_user_create()
+        company.delete(recursive=True)
+        companies = Company.search(self.session, self.session.root_dn, '(OU={0})'.format(self.test_ou))
+        self.assertEqual(len(companies), 0)
+
+    def test_company_delete_subtree_fallback(self):
+        company = self.company_with_user_create()
+        # The path taken when the server rejects the Tree Delete control
+        company._delete_subtree(self.session.deadline(), 16)
+        companies = Company.search(self.session, self.session.root_dn, '(OU={0})'.format(self.test_ou))
+        self.assertEqual(len(companies), 0)
+
 
 class UserTestCase(CommonTest):
 
@@ -93,9 +210,7 @@ class UserTestCase(CommonTest):
         self.test_password = 'VeryStrongPassword1'
 
     def tearDown(self):
-        for user in self.test_company.users:
-            user.delete()
-        self.test_company.delete()
+        self.test_company.delete(recursive=True)
 
     def user_create(self):
         return User(
@@ -134,6 +249,148 @@ class UserTestCase(CommonTest):
         self.assertEqual(len(users), 1)
         user.delete()
 
+    def test_user_search_rows(self):
+        user = self.user_create()
+        user.save()
+        rows = User.search(
+            self.session,
+            base=self.test_company.distinguished_name,
+            as_='rows',
+            attrs=['s_am_account_name', 'mail']
+        )
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].s_am_account_name, self.test_s_am_account_name)
+        self.assertEqual(rows[0].mail, self.test_mail)
+        user.delete()
+
+    def test_user_search_columns(self):
+        user = self.user_create()
+        user.save()
+        columns = User.search(
+            self.session,
+            base=self.test_company.distinguished_name,
+            as_='columns',
+            attrs=['sAMAccountName', 'given_name']
+        )
+        self.assertEqual(columns['s_am_account_name'], [self.test_s_am_account_name])
+        self.assertEqual(columns['given_name'], [self.test_given_name])
+        user.delete()
+
+    def test_user_reconcile(self):
+        desired = [{
+            's_am_account_name': self.test_s_am_account_name,
+            'given_name': self.test_given_name,
+            'sn': self.test_sn,
+            'mail': self.test_mail,
+            'display_name': self.test_display_name
+        }]
+        reconciler = Reconciler(self.session, self.test_company)
+        changes = reconciler.run(desired, dry_run=True)
+        self.assertEqual([change.action for change in changes], ['add'])
+        results = reconciler.run(desired)
+        self.assertEqual([result.error for result in results], [None])
+        self.assertEqual(len(self.test_company.users), 1)
+        desired[0]['mail'] = 'test2.user@example.com'
+        changes = reconciler.run(desired, dry_run=True)
+        self.assertEqual([change.action for change in changes], ['modify'])
+        reconciler.run(desired)
+        self.assertEqual(self.test_company.users[0].mail, 'test2.user@example.com')
+
+    def test_user_count(self):
+        base = self.test_company.distinguished_name
+        self.assertEqual(User.count(self.session, base=base), 0)
+        user = self.user_create()
+        user.save()
+        self.assertEqual(User.count(self.session, base=base), 1)
+        self.assertEqual(
+            User.group_count(self.session, 'sn', base=base),
+            {self.test_sn: 1}
+        )
+        user.delete()
+
+    def test_user_exists(self):
+        query = '(sAMAccountName={0})'.format(self.test_s_am_account_name)
+        self.assertFalse(User.exists(self.session, query))
+        user = self.user_create()
+        user.save()
+        self.assertTrue(User.exists(self.session, query))
+        user.delete()
+
+    def test_user_forest_search(self):
+        user = self.user_create()
+        user.save()
+        query = '(sAMAccountName={0})'.format(self.test_s_am_account_name)
+        rows = User.search(
+            self.session, query=query, as_='rows',
+            attrs=['s_am_account_name', 'mail'], forest=True
+        )
+        self.assertEqual([row.mail for row in rows], [self.test_mail])
+        # department is not in the Global Catalog, referrals are followed
+        columns = User.search(
+            self.session, query=query, as_='columns',
+            attrs=['s_am_account_name', 'department'], forest=True
+        )
+        self.assertEqual(columns['s_am_account_name'], [self.test_s_am_account_name])
+        self.assertRaises(
+            ValueError, User.search, self.session, query=query, forest=True
+        )
+        user.delete()
+
+    def test_user_reconcile_ad_keys(self):
+        user = self.user_create()
+        user.save()
+        reconciler = Reconciler(self.session, self.test_company)
+        changes = reconciler.run(
+            [{'sAMAccountName': self.test_s_am_account_name, 'givenName': 'New'}],
+            dry_run=True
+        )
+        self.assertEqual([change.action for change in changes], ['modify'])
+        user.delete()
+
+    def test_user_reconcile_move(self):
+        other_company = Company(self.session, ou='test_company_2')
+        other_company.save()
+        try:
+            user = self.user_create()
+            user.save()
+            desired = [{
+                's_am_account_name': self.test_s_am_account_name,
+                'parent': other_company
+            }]
+            reconciler = Reconciler(self.session, self.test_company, missing=None)
+            results = reconciler.run(desired)
+            self.assertEqual([result.change.action for result in results], ['move'])
+            self.assertEqual([result.error for result in results], [None])
+            self.assertEqual(len(other_company.users), 1)
+            # The moved user is found outside the company and not re-added
+            self.assertEqual(reconciler.run(desired, dry_run=True), [])
+            desired[0]['parent'] = self.test_company
+            changes = reconciler.run(desired, dry_run=True)
+            self.assertEqual([change.action for change in changes], ['move'])
+        finally:
+            other_company.delete(recursive=True)
+
+    def test_user_reconcile_moves_into_company(self):
+        other_company = Company(self.session, ou='test_company_2')
+        other_company.save()
+        try:
+            User(
+                self.session,
+                parent=other_company,
+                s_am_account_name=self.test_s_am_account_name,
+                given_name=self.test_given_name,
+                sn=self.test_sn
+            ).save()
+            reconciler = Reconciler(self.session, self.test_company)
+            changes = reconciler.run(
+                [{'s_am_account_name': self.test_s_am_account_name}],
+                dry_run=True
+            )
+            self.assertEqual([change.action for change in changes], ['move'])
+            self.assertEqual(changes[0].args[2], self.test_company.distinguished_name)
+        finally:
+            other_company.delete(recursive=True)
+
     def test_user_edit(self):
         NEW_USER_NAME = 'User %08d' % random.randint(0, 100000000)
         user = self.user_create()